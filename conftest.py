@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+# The TF T5 models are tf-keras layers, TensorFlow 2.16+ needs this set before it is imported to use tf-keras as tf.keras
+os.environ.setdefault("TF_USE_LEGACY_KERAS", "1")
+
+
+@pytest.fixture
+def records():
+    '''Fixture for a few fine-tuning examples in the format of load_TestData'''
+    return [
+        {"prompt": "Who was born first?", "target": "So the answer is Paris.", "answer": "Paris"},
+        {"prompt": "Where was he born?", "target": "So the answer is Rome.", "answer": "Rome"},
+        {"prompt": "When did she die?", "target": "So the answer is 1990.", "answer": "1990"},
+    ]
+
+
+@pytest.fixture
+def json_file(tmp_path, records) -> str:
+    '''Fixture for a json file holding the records fixture'''
+    from data_loaders import dump_json
+    path = str(tmp_path / "examples.json")
+    dump_json(records, path)
+    return path
@@ -1,9 +1,127 @@
-from typing import Any, Dict, List
-import json
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Union
+import mmap
 import os
 import warnings
 
-def load_2WikiMultihopQA(n_examples: int = -1, split: str = "train") -> List[Dict[str, Any]]:
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def load_json(path: str) -> Any:
+    '''Parses a json file, using orjson when it is installed.
+
+    With orjson the file is memory-mapped and the mapped buffer is parsed
+    directly, so large files are not first copied into a bytes object.
+    '''
+    with open(path, 'rb') as f:
+        if _json.__name__ != 'orjson' or os.fstat(f.fileno()).st_size == 0:
+            return _json.loads(f.read())
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with memoryview(mm) as buffer:
+                return _json.loads(buffer)
+        finally:
+            mm.close()
+
+
+@lru_cache(maxsize=2)
+def _load_json_cached(path: str, mtime: float) -> Any:
+    return load_json(path)
+
+
+def load_json_cached(path: str) -> Any:
+    '''Same as load_json, but repeated calls reuse the parsed result until the file is modified.
+
+    The cached object, including every nested dict and list, is shared between callers
+    and must not be modified in place. At most two files are kept, call
+    load_json_cached.cache_clear() to release them.
+    '''
+    path = os.path.abspath(path)
+    return _load_json_cached(path, os.path.getmtime(path))
+
+
+load_json_cached.cache_clear = _load_json_cached.cache_clear
+
+
+def _dumps(obj: Any) -> bytes:
+    data = _json.dumps(obj)
+    # orjson returns bytes, the standard library returns str
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return data
+
+
+def dump_json(obj: Any, path: str) -> None:
+    '''Serializes obj to a json file, using orjson when it is installed.'''
+    with open(path, 'wb') as f:
+        f.write(_dumps(obj))
+
+
+def iter_json_items(path: str) -> Iterator[Any]:
+    '''Yields the elements of a json list file one at a time.
+
+    With ijson installed the file is streamed, otherwise it is parsed with load_json.
+    '''
+    if ijson is None:
+        yield from load_json(path)
+        return
+    with open(path, 'rb') as f:
+        yield from ijson.items(f, 'item', use_float=True)
+
+
+def dump_json_items(items: Iterable[Any], path: str) -> None:
+    '''Writes items to a json list file one element at a time.'''
+    with open(path, 'wb') as f:
+        f.write(b'[')
+        for i, item in enumerate(items):
+            if i > 0:
+                f.write(b',')
+            f.write(_dumps(item))
+        f.write(b']')
+
+
+@dataclass
+class Examples:
+    '''Struct-of-arrays container for examples, one list per key instead of one dict per example.
+
+    Columns are available as attributes, e.g. examples.prompt. Indexing returns the
+    example as a dict and slicing returns a new Examples.
+    '''
+    columns: Dict[str, List[Any]]
+
+    @classmethod
+    def from_records(cls, records: List[Dict[str, Any]]) -> "Examples":
+        keys = records[0].keys() if records else []
+        return cls({key: [record[key] for record in records] for key in keys})
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()), []))
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Dict[str, Any], "Examples"]:
+        if isinstance(idx, slice):
+            return Examples({key: column[idx] for key, column in self.columns.items()})
+        return {key: column[idx] for key, column in self.columns.items()}
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return (self[i] for i in range(len(self)))
+
+    def __getattr__(self, key: str) -> List[Any]:
+        # only called for names that are not regular attributes
+        if key != 'columns' and key in self.columns:
+            return self.columns[key]
+        raise AttributeError(key)
+
+
+def load_2WikiMultihopQA(n_examples: int = -1, split: str = "train", as_columns: bool = False, cached: bool = False) -> Union[List[Dict[str, Any]], Examples]:
     '''Loads the 2WikiMultihopQA dataset.
 
     Parameters
@@ -11,6 +129,10 @@ def load_2WikiMultihopQA(n_examples: int = -1, split: str = "train") -> List[Dic
     n_examples (optional) : filter for first n_examples, -1 means load all examples, 
         defaults to -1
     split (optional) : load 'train', 'dev', or 'test' split, defaults to "train"
+    as_columns (optional) : return an Examples struct-of-arrays instead of a list of
+        dicts, defaults to False
+    cached (optional) : reuse the parsed file across calls until it changes on disk, the
+        returned examples are shared with the cache and must not be modified, defaults to False
 
     Returns
     -------
@@ -26,15 +148,20 @@ def load_2WikiMultihopQA(n_examples: int = -1, split: str = "train") -> List[Dic
     '''
     path = 'data/2WikiMultihopQA/'
     # load json file into dictionary
-    with open(os.path.join(path, f'{split}.json'), 'r') as f:
-        data = json.load(f)
+    load = load_json_cached if cached else load_json
+    data = load(os.path.join(path, f'{split}.json'))
     # load the first n_examples
     if n_examples > 0:
         data = data[:n_examples]
+    elif cached:
+        # copy the outer list so in-place reordering does not reach the cache
+        data = list(data)
+    if as_columns:
+        return Examples.from_records(data)
     return data
 
 
-def load_HotPotQA(n_examples: int = -1, split: str = "train") -> List[Dict[str, Any]]:
+def load_HotPotQA(n_examples: int = -1, split: str = "train", as_columns: bool = False, cached: bool = False) -> Union[List[Dict[str, Any]], Examples]:
     '''Loads the HotPotQA dataset. There are two dev sets, a full wiki and distract or. This is related to the retrieval task, the questions and answers are the same and both dev sets.
 
     Parameters
@@ -42,6 +169,10 @@ def load_HotPotQA(n_examples: int = -1, split: str = "train") -> List[Dict[str,
     n_examples (optional) : filter for first n_examples, -1 means load all examples,
         defaults to -1
     split (optional) : load 'train', 'dev', or 'test' split, defaults to "train"
+    as_columns (optional) : return an Examples struct-of-arrays instead of a list of
+        dicts, defaults to False
+    cached (optional) : reuse the parsed file across calls until it changes on disk, the
+        returned examples are shared with the cache and must not be modified, defaults to False
 
     Returns
     -------
@@ -57,15 +188,20 @@ def load_HotPotQA(n_examples: int = -1, split: str = "train") -> List[Dict[str,
     '''
     path = 'data/Super-NaturalInstructions/HotPotQA/'
     # load json file into dictionary
-    with open(os.path.join(path, f'{split}.json'), 'r') as f:
-        data = json.load(f)
+    load = load_json_cached if cached else load_json
+    data = load(os.path.join(path, f'{split}.json'))
     # load the first n_examples
     if n_examples > 0:
         data = data[:n_examples]
+    elif cached:
+        # copy the outer list so in-place reordering does not reach the cache
+        data = list(data)
+    if as_columns:
+        return Examples.from_records(data)
     return data
 
 
-def load_CompositionalCelebrities(n_examples: int = -1, split: str = "train") -> List[Dict]:
+def load_CompositionalCelebrities(n_examples: int = -1, split: str = "train", as_columns: bool = False, cached: bool = False) -> Union[List[Dict[str, Any]], Examples]:
     '''Loads the compositional celebrities dataset.
 
     Parameters
@@ -73,6 +209,10 @@ def load_CompositionalCelebrities(n_examples: int = -1, split: str = "train") ->
     n_examples (optional) : filter for first n_examples, -1 means load all examples, 
         defaults to -1
     split (optional) : load 'train', 'dev', or 'test' split, defaults to "train"
+    as_columns (optional) : return an Examples struct-of-arrays instead of a list of
+        dicts, defaults to False
+    cached (optional) : reuse the parsed file across calls until it changes on disk, the
+        returned examples are shared with the cache and must not be modified, defaults to False
 
     Returns
     -------
@@ -83,15 +223,20 @@ def load_CompositionalCelebrities(n_examples: int = -1, split: str = "train") ->
     # TODO split json into train, dev, test, modify code below
     # add warning that the loader only reads the entire file
     warnings.warn("There is only one file. The data has not been splitted yet.")
-    with open(os.path.join(path, f'compositional_celebrities.json'), 'r') as f:
-        data = json.load(f)['data']
+    load = load_json_cached if cached else load_json
+    data = load(os.path.join(path, f'compositional_celebrities.json'))['data']
     # load the first n_examples
     if n_examples > 0:
         data = data[:n_examples]
+    elif cached:
+        # copy the outer list so in-place reordering does not reach the cache
+        data = list(data)
+    if as_columns:
+        return Examples.from_records(data)
     return data
 
 
-def load_FinetuningData(n_examples: int = -1, split: str = "train", strategy: str = "direct") -> List[Dict]:
+def load_FinetuningData(n_examples: int = -1, split: str = "train", strategy: str = "direct", as_columns: bool = False, cached: bool = False) -> Union[List[Dict[str, Any]], Examples]:
     '''Loads the restructured version of the 2WikiMultihopQA dataset for fine-tuning.
 
     Parameters
@@ -102,6 +247,10 @@ def load_FinetuningData(n_examples: int = -1, split: str = "train", strategy: st
     strategy (optional) : specify prompting strategy, possible values are
         - "direct": directly prompt the model with the question
         - "self_ask": prompt and target augmented with self-ask rationale
+    as_columns (optional) : return an Examples struct-of-arrays instead of a list of
+        dicts, defaults to False
+    cached (optional) : reuse the parsed file across calls until it changes on disk, the
+        returned examples are shared with the cache and must not be modified, defaults to False
 
     Returns
     -------
@@ -109,15 +258,20 @@ def load_FinetuningData(n_examples: int = -1, split: str = "train", strategy: st
     '''
     path = 'data/FinetuningData/'
     # load json file into dictionary
-    with open(os.path.join(path, f'{strategy}_{split}.json'), 'r') as f:
-        data = json.load(f)
+    load = load_json_cached if cached else load_json
+    data = load(os.path.join(path, f'{strategy}_{split}.json'))
     # load the first n_examples
     if n_examples > 0:
         data = data[:n_examples]
+    elif cached:
+        # copy the outer list so in-place reordering does not reach the cache
+        data = list(data)
+    if as_columns:
+        return Examples.from_records(data)
     return data
 
 
-def load_TestData(file: str, n_examples: int = -1) -> List[Dict]:
+def load_TestData(file: str, n_examples: int = -1, as_columns: bool = False, cached: bool = False) -> Union[List[Dict[str, Any]], Examples]:
     '''Loads the restructured version of the 2WikiMultihopQA test dataset for evaluation.
 
     Parameters
@@ -125,6 +279,10 @@ def load_TestData(file: str, n_examples: int = -1) -> List[Dict]:
     file : path to the json file
     n_examples (optional) : filter for first n_examples, -1 means load all examples, 
         defaults to -1
+    as_columns (optional) : return an Examples struct-of-arrays instead of a list of
+        dicts, defaults to False
+    cached (optional) : reuse the parsed file across calls until it changes on disk, the
+        returned examples are shared with the cache and must not be modified, defaults to False
 
     Returns
     -------
@@ -132,15 +290,20 @@ def load_TestData(file: str, n_examples: int = -1) -> List[Dict]:
     {"prompt": ..., "target": ..., "answer": ...}
     '''
     # load json file into dictionary
-    with open(file, 'r') as f:
-        data = json.load(f)
+    load = load_json_cached if cached else load_json
+    data = load(file)
     # load the first n_examples
     if n_examples > 0:
         data = data[:n_examples]
+    elif cached:
+        # copy the outer list so in-place reordering does not reach the cache
+        data = list(data)
+    if as_columns:
+        return Examples.from_records(data)
     return data
 
 
-def load_StrategyQA(split: str = "train", n_examples: int = -1) -> List[Dict]:
+def load_StrategyQA(split: str = "train", n_examples: int = -1, as_columns: bool = False, cached: bool = False) -> Union[List[Dict[str, Any]], Examples]:
     '''Loads the StrategyQA dataset.
 
     Parameters
@@ -148,6 +311,10 @@ def load_StrategyQA(split: str = "train", n_examples: int = -1) -> List[Dict]:
     split (optional) : load 'train', 'dev', or 'test' split, defaults to "train"
     n_examples (optional) : filter for first n_examples, -1 means load all examples, 
         defaults to -1
+    as_columns (optional) : return an Examples struct-of-arrays instead of a list of
+        dicts, defaults to False
+    cached (optional) : reuse the parsed file across calls until it changes on disk, the
+        returned examples are shared with the cache and must not be modified, defaults to False
 
     Returns
     -------
@@ -169,9 +336,14 @@ def load_StrategyQA(split: str = "train", n_examples: int = -1) -> List[Dict]:
     '''
     path = 'data/StrategyQA/'
     # load json file into dictionary
-    with open(os.path.join(path, f'{split}.json'), 'r') as f:
-        data = json.load(f)
+    load = load_json_cached if cached else load_json
+    data = load(os.path.join(path, f'{split}.json'))
     # load the first n_examples
     if n_examples > 0:
         data = data[:n_examples]
+    elif cached:
+        # copy the outer list so in-place reordering does not reach the cache
+        data = list(data)
+    if as_columns:
+        return Examples.from_records(data)
     return data
@@ -55,7 +55,7 @@ from dataclasses import dataclass
 from typing import Any, Dict, List, Tuple, Iterable
 from training_utils import qa_split, build_t5_training_wrapper_model
 import json
-from data_loaders import load_TestData
+from data_loaders import Examples, load_TestData
 from tqdm import tqdm
 import argparse
 from rouge_score.rouge_scorer import RougeScorer
@@ -211,11 +211,12 @@ def load_model(config: EvaluationConfig) -> Any:
         raise ValueError("Model not found.")
 
 
-def load_batch(config: EvaluationConfig, idx_range: Tuple[int, int]) -> List[Dict[str, str]]:
+def load_batch(config: EvaluationConfig, idx_range: Tuple[int, int]) -> Examples:
     '''Loads a slice of the test set.'''
     file = config.generate_test_set_file()
-    data = load_TestData(file=file, n_examples=-1)
-    batch = data[idx_range[0]:idx_range[1]]
+    # the parsed test set is cached across batches, only the slice is converted
+    data = load_TestData(file=file, n_examples=-1, cached=True)
+    batch = Examples.from_records(data[idx_range[0]:idx_range[1]])
     del data
     # logger.info(f"Loading batch {batch[0]}...")
     return batch
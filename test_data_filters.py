@@ -0,0 +1,47 @@
+import pytest
+from data_loaders import load_json, dump_json
+from data_filters import (
+    extract_answer_from_target,
+    answer_in_prompt,
+    verify_answer_in_prompt,
+    filter_token_size
+    )
+
+
+@pytest.mark.parametrize("target, answer", [
+    ("So the answer is Paris.", "Paris"),
+    ("Follow up: where? So the answer is  New York City .", "New York City"),
+    ("The answer is 1990. Then more text.", "1990"),
+    ("There is no answer here", None),
+])
+def test_extract_answer_from_target(target: str, answer: str) -> None:
+    '''Test the answer is the text between "answer is" and the next period'''
+    assert extract_answer_from_target(target) == answer
+
+
+def test_answer_in_prompt(records) -> None:
+    '''Test only examples whose answer appears in the prompt are kept'''
+    records[0]["prompt"] = "Was Paris or Rome founded first?"
+    assert answer_in_prompt(records[0])
+    assert not answer_in_prompt(records[1])
+
+    # a target without an answer is rejected instead of matching every prompt
+    assert not answer_in_prompt({"prompt": "Who was born first?", "target": "I do not know"})
+
+
+def test_filters_end_to_end(records, tmp_path) -> None:
+    '''Test verify_answer_in_prompt and filter_token_size write the filtered train and validation files'''
+    records[0]["prompt"] = "Was Paris or Rome founded first?"
+    for record, num_prompt_tokens in zip(records, [4, 12, 8]):
+        record["num_prompt_tokens"] = num_prompt_tokens
+    train_file, valid_file = str(tmp_path / "train.json"), str(tmp_path / "dev.json")
+    dump_json(records, train_file)
+    dump_json(records[1:], valid_file)
+
+    verify_answer_in_prompt(train_file, valid_file)
+    assert load_json(str(tmp_path / "train_answer_verified.json")) == records[:1]
+    assert load_json(str(tmp_path / "dev_answer_verified.json")) == []
+
+    filter_token_size(train_file, valid_file, 8)
+    assert load_json(str(tmp_path / "train_8.json")) == [records[0], records[2]]
+    assert load_json(str(tmp_path / "dev_8.json")) == [records[2]]
@@ -0,0 +1,76 @@
+import pytest
+import data_loaders
+from data_loaders import Examples, load_json, load_json_cached, load_TestData, iter_json_items, dump_json_items
+
+
+def test_examples_indexing(records) -> None:
+    '''Test Examples indexing, slicing and attribute access'''
+    examples = Examples.from_records(records)
+    assert len(examples) == 3
+    assert examples[1] == records[1]
+    assert list(examples) == records
+    assert examples.prompt == [record["prompt"] for record in records]
+
+    sliced = examples[1:]
+    assert isinstance(sliced, Examples)
+    assert len(sliced) == 2
+    assert sliced.answer == ["Rome", "1990"]
+
+    with pytest.raises(AttributeError):
+        examples.missing_key
+
+
+def test_examples_empty() -> None:
+    '''Test Examples built from no records'''
+    examples = Examples.from_records([])
+    assert len(examples) == 0
+    assert list(examples) == []
+    assert len(examples[:2]) == 0
+
+
+def test_load_json(json_file: str, records, tmp_path) -> None:
+    '''Test load_json on a regular and an empty file'''
+    assert load_json(json_file) == records
+
+    # an empty file cannot be memory-mapped, it must fail like a regular parse error
+    empty_file = tmp_path / "empty.json"
+    empty_file.write_bytes(b"")
+    with pytest.raises(ValueError):
+        load_json(str(empty_file))
+
+
+@pytest.mark.parametrize("streaming", [True, False], ids=["ijson", "load_json"])
+def test_json_items_round_trip(records, tmp_path, monkeypatch, streaming: bool) -> None:
+    '''Test dump_json_items writes a json list that iter_json_items reads back, with and without ijson'''
+    if not streaming:
+        monkeypatch.setattr(data_loaders, "ijson", None)
+    elif data_loaders.ijson is None:
+        pytest.skip("ijson is not installed")
+
+    path = str(tmp_path / "items.json")
+    dump_json_items(iter(records), path)
+    assert load_json(path) == records
+    assert list(iter_json_items(path)) == records
+
+    dump_json_items(iter([]), path)
+    assert load_json(path) == []
+    assert list(iter_json_items(path)) == []
+
+
+def test_load_TestData_cache(json_file: str, records) -> None:
+    '''Test uncached loads are independent and cached loads share the examples but not the outer list'''
+    first = load_TestData(json_file)
+    first[0]["prompt"] = "changed"
+    first.reverse()
+    assert load_TestData(json_file) == records
+
+    load_json_cached.cache_clear()
+    try:
+        first = load_TestData(json_file, cached=True)
+        first.reverse()
+        second = load_TestData(json_file, cached=True)
+        assert second == records
+        assert second[0] is first[-1]
+        assert load_TestData(json_file, n_examples=2, cached=True) == records[:2]
+    finally:
+        load_json_cached.cache_clear()
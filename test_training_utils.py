@@ -0,0 +1,299 @@
+import os
+import numpy as np
+import pytest
+import tensorflow as tf
+from tokenizers import Tokenizer, models, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast, T5Config, TFT5ForConditionalGeneration
+from data_loaders import Examples, dump_json
+import training_utils
+from training_utils import (
+    qa_split,
+    encode_pairs,
+    token_cache_paths,
+    load_token_cache,
+    MultihopQADataGenerator,
+    PRECISION_POLICIES,
+    build_t5_training_wrapper_model,
+    finetune_self_ask
+    )
+
+
+MAX_LENGTH = 16
+PAD_TOKEN_ID = 0
+
+
+class FakeTokenizer(object):
+    '''Stand-in for the T5 tokenizer, the data generator only reads these attributes'''
+    pad_token_id = PAD_TOKEN_ID
+    name_or_path = "fake-t5"
+
+
+class FakeModel(object):
+    '''Stand-in for the T5 model, shifts labels right like T5 does'''
+    def _shift_right(self, label_ids):
+        shifted = np.zeros_like(label_ids)
+        shifted[:, 1:] = label_ids[:, :-1]
+        return shifted
+
+
+@pytest.fixture
+def tokenizer(records) -> PreTrainedTokenizerFast:
+    '''Fixture for a small word-level fast tokenizer over the records vocabulary'''
+    words = sorted({
+        word
+        for record in records
+        for text in (record["prompt"], record["target"])
+        for word in text.split()
+    })
+    vocab = {"<pad>": 0, "</s>": 1, "<unk>": 2, **{word: i + 3 for i, word in enumerate(words)}}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    # append </s> like the T5 tokenizer
+    backend.post_processor = processors.TemplateProcessing(single="$A </s>", special_tokens=[("</s>", 1)])
+    return PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        pad_token="<pad>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        name_or_path="local/word-level",
+        clean_up_tokenization_spaces=False
+    )
+
+
+@pytest.mark.parametrize("padding", ["max_length", "longest"])
+def test_encode_pairs(records, tokenizer, padding: str) -> None:
+    '''Test encode_pairs returns int32 arrays padded to max_length or to the longest text'''
+    text_pairs = [(record["prompt"], record["target"]) for record in records]
+    input_ids, attention_mask, label_ids = encode_pairs(text_pairs, tokenizer, MAX_LENGTH, padding=padding)
+
+    prompt_lengths = [len(prompt.split()) + 1 for prompt, _ in text_pairs]
+    target_lengths = [len(target.split()) + 1 for _, target in text_pairs]
+    prompt_width = MAX_LENGTH if padding == "max_length" else max(prompt_lengths)
+    target_width = MAX_LENGTH if padding == "max_length" else max(target_lengths)
+    for array in (input_ids, attention_mask, label_ids):
+        assert array.dtype == np.int32
+    assert input_ids.shape == attention_mask.shape == (len(records), prompt_width)
+    assert label_ids.shape == (len(records), target_width)
+
+    assert attention_mask.sum(axis=1).tolist() == prompt_lengths
+    assert np.array_equal(attention_mask, (input_ids != PAD_TOKEN_ID).astype(np.int32))
+    assert (label_ids != PAD_TOKEN_ID).sum(axis=1).tolist() == target_lengths
+
+
+def _cache_files(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if "_tokens_" in name)
+
+
+def test_load_token_cache_builds_cache(json_file: str, records, tokenizer, tmp_path) -> None:
+    '''Test load_token_cache tokenizes the data file into a cache keyed by tokenizer and max_length'''
+    input_ids, attention_mask, labels = load_token_cache(json_file, tokenizer, MAX_LENGTH)
+
+    prefix = str(tmp_path / f"examples_tokens_local--word-level_{MAX_LENGTH}")
+    assert _cache_files(tmp_path) == sorted(os.path.basename(path) for path in token_cache_paths(prefix).values())
+
+    text_pairs = [(record["prompt"], record["target"]) for record in records]
+    expected = encode_pairs(text_pairs, tokenizer, MAX_LENGTH)
+    for array, expected_array in zip((input_ids, attention_mask, labels), expected):
+        assert array.dtype == np.int32
+        assert array.shape == (len(records), MAX_LENGTH)
+        assert np.array_equal(array, expected_array)
+
+
+def test_load_token_cache_key(json_file: str, tokenizer, tmp_path) -> None:
+    '''Test caches for different tokenizers or max_length do not collide'''
+    load_token_cache(json_file, tokenizer, MAX_LENGTH)
+    load_token_cache(json_file, tokenizer, MAX_LENGTH * 2)
+    tokenizer.name_or_path = "other-tokenizer"
+    load_token_cache(json_file, tokenizer, MAX_LENGTH)
+    assert len(_cache_files(tmp_path)) == 3 * len(training_utils.TOKEN_ARRAYS)
+
+
+def test_load_token_cache_staleness(json_file: str, tokenizer, monkeypatch) -> None:
+    '''Test the cache is reused until the data file is newer than it'''
+    load_token_cache(json_file, tokenizer, MAX_LENGTH)
+
+    calls = []
+    monkeypatch.setattr(training_utils, "precompute_tokens", lambda *args: calls.append(args))
+    load_token_cache(json_file, tokenizer, MAX_LENGTH)
+    assert calls == []
+
+    # touching the data file makes the cache stale
+    future = os.path.getmtime(json_file) + 60
+    os.utime(json_file, (future, future))
+    load_token_cache(json_file, tokenizer, MAX_LENGTH)
+    assert len(calls) == 1
+
+
+def test_precompute_tokens_is_atomic(json_file: str, tokenizer, tmp_path, monkeypatch) -> None:
+    '''Test an interrupted precompute_tokens leaves no partial or temporary files behind'''
+    load_token_cache(json_file, tokenizer, MAX_LENGTH)
+    cache_files = _cache_files(tmp_path)
+    prefix = str(tmp_path / f"examples_tokens_local--word-level_{MAX_LENGTH}")
+    before = {path: np.load(path) for path in token_cache_paths(prefix).values()}
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(training_utils, "encode_pairs", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        training_utils.precompute_tokens(json_file, tokenizer, MAX_LENGTH, prefix)
+
+    # the temporary files are removed and the complete cache is untouched
+    assert _cache_files(tmp_path) == cache_files
+    for path, array in before.items():
+        assert np.array_equal(np.load(path), array)
+
+
+def _write_token_cache(tmp_path, prompt_lengths, target_lengths, max_length):
+    '''Writes a data file and a token cache whose rows have the given unpadded lengths'''
+    data_filename = str(tmp_path / "train.json")
+    dump_json([{"prompt": "", "target": ""}] * len(prompt_lengths), data_filename)
+
+    def padded(lengths):
+        ids = np.full((len(lengths), max_length), PAD_TOKEN_ID, dtype=np.int32)
+        for row, length in enumerate(lengths):
+            ids[row, :length] = np.arange(1, length + 1)
+        return ids
+
+    token_cache = str(tmp_path / "train_tokens")
+    input_ids = padded(prompt_lengths)
+    arrays = {
+        "input_ids": input_ids,
+        "attention_mask": (input_ids != PAD_TOKEN_ID).astype(np.int32),
+        "labels": padded(target_lengths),
+    }
+    # written after the data file, so the cache is not considered stale
+    for name, path in token_cache_paths(token_cache).items():
+        np.save(path, arrays[name])
+    return data_filename, token_cache
+
+
+def _data_generator(data_filename, token_cache, max_length, batch_size, **kwargs) -> MultihopQADataGenerator:
+    return MultihopQADataGenerator(
+        tokenizer=FakeTokenizer(),
+        model=FakeModel(),
+        n_examples=None,
+        data_filename=data_filename,
+        max_length=max_length,
+        batch_size=batch_size,
+        token_cache=token_cache,
+        **kwargs
+    )
+
+
+@pytest.mark.parametrize(
+    "prompt_lengths, target_lengths, pad_to_multiple_of, expected_shapes",
+    [
+        ([5, 40], [3, 10], 1, ((2, 40), (2, 10))),
+        ([5, 40], [3, 10], 32, ((2, 64), (2, 32))),
+        ([5, 40], [3, 10], 8, ((2, 40), (2, 16))),
+        ([90, 100], [1, 1], 32, ((2, 100), (2, 32))),
+    ],
+    ids=["longest", "bucket-32", "bucket-8", "capped-at-max-length"]
+)
+def test_data_generator_trims_batches(tmp_path, prompt_lengths, target_lengths, pad_to_multiple_of, expected_shapes) -> None:
+    '''Test MultihopQADataGenerator trims batches to their longest example, rounded up to a bucket below max_length'''
+    max_length = 100
+    data_filename, token_cache = _write_token_cache(tmp_path, prompt_lengths, target_lengths, max_length)
+    generator = _data_generator(data_filename, token_cache, max_length, batch_size=2,
+                                shuffle=False, pad_to_multiple_of=pad_to_multiple_of)
+    assert len(generator) == 1
+
+    (input_ids, attention_mask, decoder_input_ids), label_ids = generator[0]
+    prompt_shape, target_shape = expected_shapes
+    assert input_ids.shape == prompt_shape
+    assert attention_mask.shape == prompt_shape
+    assert label_ids.shape == target_shape
+    assert decoder_input_ids.shape == target_shape
+    # trimming only removes padding
+    assert attention_mask.sum() == sum(prompt_lengths)
+    assert (label_ids != PAD_TOKEN_ID).sum() == sum(target_lengths)
+
+
+def test_data_generator_seeded_shuffle(tmp_path) -> None:
+    '''Test the same seed gives the same row order on every epoch and the order stays a permutation'''
+    n_examples = 20
+    data_filename, token_cache = _write_token_cache(tmp_path, [1] * n_examples, [1] * n_examples, MAX_LENGTH)
+    first, second = (
+        _data_generator(data_filename, token_cache, MAX_LENGTH, batch_size=4, seed=7) for _ in range(2)
+    )
+    for _ in range(3):
+        assert first.row_order.dtype == np.int32
+        assert np.array_equal(first.row_order, second.row_order)
+        assert sorted(first.row_order.tolist()) == list(range(n_examples))
+        first.on_epoch_end()
+        second.on_epoch_end()
+
+    unshuffled = _data_generator(data_filename, token_cache, MAX_LENGTH, batch_size=4, shuffle=False, seed=7)
+    assert unshuffled.row_order.tolist() == list(range(n_examples))
+
+
+@pytest.mark.parametrize("as_columns", [False, True], ids=["records", "columns"])
+def test_qa_split(records, as_columns: bool) -> None:
+    '''Test qa_split on a list of dicts and on Examples'''
+    examples = Examples.from_records(records) if as_columns else records
+    questions, answers = qa_split(examples)
+    assert list(questions) == [record["prompt"] for record in records]
+    assert list(answers) == [record["target"] for record in records]
+
+    questions, targets, answers = qa_split(examples, triple=True)
+    assert list(answers) == [record["answer"] for record in records]
+    if as_columns:
+        # the Examples columns are handed over without copying
+        assert questions is examples.prompt
+
+
+def test_qa_split_empty() -> None:
+    '''Test qa_split returns one empty list per key'''
+    assert qa_split([]) == ([], [])
+    assert qa_split([], triple=True) == ([], [], [])
+
+
+def test_as_dataset(tmp_path) -> None:
+    '''Test as_dataset yields the generator batches as int32 tensors with a known cardinality'''
+    max_length = 8
+    data_filename, token_cache = _write_token_cache(tmp_path, [2, 5, 3, 8, 1], [1, 2, 3, 4, 5], max_length)
+    generator = _data_generator(data_filename, token_cache, max_length, batch_size=2, shuffle=False)
+    dataset = generator.as_dataset()
+    assert dataset.cardinality().numpy() == len(generator) == 2
+
+    batches = list(dataset)
+    assert len(batches) == len(generator)
+    for idx, (inputs, label_ids) in enumerate(batches):
+        expected_inputs, expected_label_ids = generator[idx]
+        assert len(inputs) == 3
+        for tensor, expected in zip((*inputs, label_ids), (*expected_inputs, expected_label_ids)):
+            assert tensor.dtype == tf.int32
+            assert np.array_equal(tensor.numpy(), expected)
+
+
+@pytest.mark.parametrize("precision_policy", PRECISION_POLICIES)
+def test_wrapper_model_loss_is_finite(precision_policy: str) -> None:
+    '''Test a small T5 wrapper model trains to a finite loss under each accepted precision policy'''
+    previous_policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(precision_policy)
+    try:
+        config = T5Config(vocab_size=32, d_model=16, d_kv=4, d_ff=32, num_layers=1, num_heads=2,
+                          decoder_start_token_id=PAD_TOKEN_ID, pad_token_id=PAD_TOKEN_ID)
+        t5_model = TFT5ForConditionalGeneration(config)
+        model = build_t5_training_wrapper_model(t5_model, max_length=MAX_LENGTH)
+
+        rng = np.random.default_rng(0)
+        input_ids = rng.integers(1, 32, size=(8, MAX_LENGTH), dtype=np.int32)
+        attention_mask = np.ones_like(input_ids)
+        label_ids = rng.integers(1, 32, size=(8, MAX_LENGTH), dtype=np.int32)
+        decoder_input_ids = t5_model._shift_right(label_ids)
+        history = model.fit([input_ids, attention_mask, decoder_input_ids], label_ids,
+                            validation_data=([input_ids, attention_mask, decoder_input_ids], label_ids),
+                            batch_size=4, epochs=2, verbose=0)
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+    assert np.isfinite(history.history["loss"]).all()
+    assert np.isfinite(history.history["val_loss"]).all()
+
+
+def test_finetune_self_ask_rejects_float16() -> None:
+    '''Test finetune_self_ask refuses mixed_float16 before loading anything'''
+    with pytest.raises(ValueError, match="mixed_float16"):
+        finetune_self_ask("unused-model", "train.json", "dev.json", "weights.hdf5", precision_policy="mixed_float16")
@@ -1,62 +1,149 @@
-from typing import Dict, List
+from typing import Dict, List, Union
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+import copy
+import inspect
 import os
-import re
 import numpy as np
-import pandas as pd
 
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
-from transformers import T5Tokenizer, TFT5ForConditionalGeneration
-
-import json
+from transformers import T5TokenizerFast, TFT5ForConditionalGeneration
+
+from data_loaders import Examples, load_json
+# the json filters live in a TensorFlow-free module, re-exported here for existing callers
+from data_filters import (
+    extract_answer_from_target,
+    answer_in_prompt,
+    filter_json_file,
+    filter_json_files,
+    verify_answer_in_prompt,
+    within_token_size,
+    filter_token_size
+    )
 
 
-def qa_split(examples: List[Dict[str, str]], triple=False) -> List[str]:
+def qa_split(examples: Union[List[Dict[str, str]], Examples], triple=False) -> List[str]:
     '''Splits the examples into questions and answers.
     
     Adapts structure of output of load_FinetuningData for tokenizer.
     '''
-    if triple:
-        questions = [example["prompt"] for example in examples]
-        targets = [example["target"] for example in examples]
-        answers = [example["answer"] for example in examples]
-        return questions, targets, answers
-    else:
-        questions = [example["prompt"] for example in examples]
-        answers = [example["target"] for example in examples]
-        return questions, answers
+    keys = ("prompt", "target", "answer") if triple else ("prompt", "target")
+    if isinstance(examples, Examples):
+        # the columns are already lists of strings, hand them over without copying
+        return tuple(getattr(examples, key) for key in keys)
+    columns = zip(*map(itemgetter(*keys), examples))
+    # empty input still returns one empty list per key
+    return tuple(list(column) for column in columns) or tuple([] for _ in keys)
 
 
-def preprocess_data(text_pairs, tokenizer, model, max_length=512):
-    prompt_text = [prompt for prompt, target in text_pairs]
+def encode_pairs(text_pairs, tokenizer, max_length=512, padding='max_length'):
+    '''Tokenizes (prompt, target) pairs into int32 input ids, attention masks and labels.
+
+    padding='longest' pads to the longest sequence in text_pairs instead of max_length.
+    '''
+    prompt_text, target_text = map(list, zip(*text_pairs))
     prompt_encoded = tokenizer.batch_encode_plus(
         prompt_text,
         max_length=max_length,
-        padding='max_length',
+        padding=padding,
         truncation=True,
         return_attention_mask=True,
-        return_tensors='tf'
+        return_tensors='np'
     )
 
-    prompt_input_ids = np.array(prompt_encoded["input_ids"], dtype="int32")
-    prompt_attention_masks = np.array(prompt_encoded["attention_mask"], dtype="int32")
+    # the fast tokenizer returns int64, so narrowing to int32 copies each array once
+    prompt_input_ids = prompt_encoded["input_ids"].astype(np.int32)
+    prompt_attention_masks = prompt_encoded["attention_mask"].astype(np.int32)
 
-    target_text = [target for orig, target in text_pairs]
     target_encoded = tokenizer.batch_encode_plus(
         target_text,
         max_length=max_length,
-        padding='max_length',
+        padding=padding,
         truncation=True,
-        return_tensors='tf'
+        return_tensors='np'
     )
 
-    label_ids = np.array(target_encoded['input_ids'])
-    decoder_input_ids = model._shift_right(label_ids)
+    label_ids = target_encoded['input_ids'].astype(np.int32)
+
+    return prompt_input_ids, prompt_attention_masks, label_ids
+
+
+def preprocess_data(text_pairs, tokenizer, model, max_length=512):
+    prompt_input_ids, prompt_attention_masks, label_ids = encode_pairs(
+        text_pairs, tokenizer, max_length, padding='longest')
+    decoder_input_ids = model._shift_right(tf.convert_to_tensor(label_ids))
 
     return [prompt_input_ids, prompt_attention_masks, decoder_input_ids], label_ids
 
 
+TOKEN_ARRAYS = ('input_ids', 'attention_mask', 'labels')
+
+
+def token_cache_paths(out_path: str) -> Dict[str, str]:
+    '''Returns the .npy file of each array written by precompute_tokens.'''
+    return {name: f'{out_path}_{name}.npy' for name in TOKEN_ARRAYS}
+
+
+def precompute_tokens(data_filename, tokenizer, max_length, out_path, chunk_size=1024):
+    '''Tokenizes a prompt/target json file once and stores the token ids on disk.
+
+    Writes one int32 array of shape (n_examples, max_length) per entry of
+    TOKEN_ARRAYS, so training can memory-map the ids instead of tokenizing
+    the same text every epoch.
+    '''
+    # Keep only the two text columns, the example dicts are released before tokenizing
+    prompts, targets = qa_split(load_json(data_filename))
+    shape = (len(prompts), max_length)
+
+    # Write to temporary files and only move them into place once every array is complete,
+    # so an interrupted run never leaves a partially filled cache behind
+    cache_paths = token_cache_paths(out_path)
+    tmp_paths = {name: path + '.tmp' for name, path in cache_paths.items()}
+    try:
+        arrays = {
+            name: np.lib.format.open_memmap(path, mode='w+', dtype=np.int32, shape=shape)
+            for name, path in tmp_paths.items()
+        }
+
+        for chunk_start in range(0, len(prompts), chunk_size):
+            chunk_end = min(chunk_start + chunk_size, len(prompts))
+            text_pairs = list(zip(prompts[chunk_start:chunk_end], targets[chunk_start:chunk_end]))
+            encoded = encode_pairs(text_pairs, tokenizer, max_length)
+            for name, values in zip(TOKEN_ARRAYS, encoded):
+                arrays[name][chunk_start:chunk_end] = values
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        for name in TOKEN_ARRAYS:
+            os.replace(tmp_paths[name], cache_paths[name])
+    finally:
+        for path in tmp_paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def load_token_cache(data_filename, tokenizer, max_length, token_cache=None):
+    '''Memory-maps the token arrays of a data file, running precompute_tokens if they are missing or stale.
+
+    By default the cache is stored next to the data file and named after the tokenizer and
+    max_length, so models with different vocabularies never share token ids.
+    Returns the input_ids, attention_mask and labels arrays.
+    '''
+    if token_cache is None:
+        tokenizer_name = tokenizer.name_or_path.rstrip('/').replace('/', '--')
+        token_cache = data_filename.replace(".json", "") + '_tokens_' + tokenizer_name + '_' + str(max_length)
+    cache_paths = token_cache_paths(token_cache)
+    data_mtime = os.path.getmtime(data_filename)
+    if not all(os.path.exists(path) and os.path.getmtime(path) >= data_mtime
+               for path in cache_paths.values()):
+        precompute_tokens(data_filename, tokenizer, max_length, token_cache)
+    return tuple(np.load(cache_paths[name], mmap_mode='r') for name in TOKEN_ARRAYS)
+
+
 class MultihopQADataGenerator(tf.keras.utils.Sequence):
 
     def __init__(self,
@@ -66,7 +153,10 @@ class MultihopQADataGenerator(tf.keras.utils.Sequence):
                  data_filename,
                  max_length=512,
                  batch_size=16,
-                 shuffle=True):
+                 shuffle=True,
+                 token_cache=None,
+                 pad_to_multiple_of=32,
+                 seed=None):
 
         self.tokenizer = tokenizer
         self.model = model
@@ -75,9 +165,20 @@ class MultihopQADataGenerator(tf.keras.utils.Sequence):
         self.max_length = max_length
         self.batch_size = batch_size
         self.shuffle = shuffle
+        self.pad_to_multiple_of = pad_to_multiple_of
 
-        # Initialize row order, call on_epoch_end to shuffle row indices
-        self.row_order = np.arange(1, self.n_examples+1)
+        # Tokenize the data file once, batches are sliced from the memory-mapped ids
+        self.input_ids, self.attention_mask, self.labels = load_token_cache(
+            self.data_filename, self.tokenizer, self.max_length, token_cache)
+
+        # Default to every example in the data file
+        if self.n_examples is None:
+            self.n_examples = len(self.input_ids)
+
+        # Initialize row order, call on_epoch_end to shuffle row indices in place
+        self.row_order = np.arange(self.n_examples, dtype=np.int32)
+        # seed makes the shuffle order reproducible, None draws fresh entropy
+        self._rng = np.random.default_rng(seed)
         self.on_epoch_end()
 
     def __len__(self):
@@ -88,22 +189,25 @@ class MultihopQADataGenerator(tf.keras.utils.Sequence):
         batch_start = idx * self.batch_size
         batch_end = (idx + 1) * self.batch_size
 
-        # Indices to skip are the ones in the shuffled row_order before and
-        # after the chunk we'll use for this batch
-        batch_idx_skip = self.row_order[:batch_start] + self.row_order[batch_end:]
-        df = pd.read_json(self.data_filename)
-        df = df.iloc[batch_start : batch_end]
+        # Rows for this batch are the chunk of the shuffled row_order
+        batch_rows = self.row_order[batch_start:batch_end]
 
-        text_pairs = df[['prompt', 'target']].values.astype(str).tolist()
+        # The cache is padded to max_length, trim the batch to its longest prompt and target
+        attention_mask = self.attention_mask[batch_rows]
+        prompt_length = max(attention_mask.sum(axis=1).max(), 1)
+        label_ids = self.labels[batch_rows]
+        target_length = max((label_ids != self.tokenizer.pad_token_id).sum(axis=1).max(), 1)
 
-        batch_data = preprocess_data(
-            text_pairs,
-            self.tokenizer,
-            self.model,
-            self.max_length
-        )
+        # Round lengths up to a few buckets so a jit-compiled model is not retraced for every batch
+        prompt_length = min(-(-prompt_length // self.pad_to_multiple_of) * self.pad_to_multiple_of, self.max_length)
+        target_length = min(-(-target_length // self.pad_to_multiple_of) * self.pad_to_multiple_of, self.max_length)
 
-        return batch_data
+        input_ids = self.input_ids[batch_rows, :prompt_length]
+        attention_mask = attention_mask[:, :prompt_length]
+        label_ids = label_ids[:, :target_length]
+        decoder_input_ids = self.model._shift_right(label_ids)
+
+        return [input_ids, attention_mask, decoder_input_ids], label_ids
 
     def __call__(self):
         for i in range(self.__len__()):
@@ -112,164 +216,230 @@ class MultihopQADataGenerator(tf.keras.utils.Sequence):
             if i == self.__len__()-1:
                 self.on_epoch_end()
 
+    def as_dataset(self):
+        '''Wraps the generator in a tf.data pipeline that prepares batches ahead of the training step.'''
+        def batches():
+            for inputs, label_ids in self():
+                yield tuple(inputs), label_ids
+
+        ids_spec = tf.TensorSpec(shape=(None, None), dtype=tf.int32)
+        dataset = tf.data.Dataset.from_generator(
+            batches,
+            output_signature=((ids_spec, ids_spec, ids_spec), ids_spec)
+        )
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(len(self)))
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+        # Stage the next batches on the GPU so the training step does not wait for host-to-device copies
+        if tf.config.list_logical_devices('GPU'):
+            dataset = dataset.apply(tf.data.experimental.prefetch_to_device('/GPU:0', buffer_size=2))
+        return dataset
+
     def on_epoch_end(self):
         if self.shuffle:
-            self.row_order = list(np.random.permutation(self.row_order))
+            self._rng.shuffle(self.row_order)
 
 
-def build_t5_training_wrapper_model(t5_model, max_length):
-    input_ids = layers.Input(shape=(max_length), dtype=tf.int32, name='input_ids')
-    attention_mask = layers.Input(shape=(max_length), dtype=tf.int32, name='attention_mask')
-    decoder_input_ids = layers.Input(shape=(max_length), dtype=tf.int32, name='labels')
+def build_t5_training_wrapper_model(t5_model, max_length, jit_compile=False):
+    # Sequence length is left open so batches can be padded to their longest example,
+    # max_length is kept for existing callers
+    input_ids = layers.Input(shape=(None,), dtype=tf.int32, name='input_ids')
+    attention_mask = layers.Input(shape=(None,), dtype=tf.int32, name='attention_mask')
+    decoder_input_ids = layers.Input(shape=(None,), dtype=tf.int32, name='labels')
 
     t5_logits = t5_model(input_ids, attention_mask=attention_mask, decoder_input_ids=decoder_input_ids)[0]
+    # Under a mixed precision policy the logits are 16-bit, compute the loss in float32
+    t5_logits = layers.Activation('linear', dtype='float32')(t5_logits)
 
     model = tf.keras.models.Model(inputs=[input_ids, attention_mask, decoder_input_ids],
                                   outputs=[t5_logits])
+    # XLA fuses the T5 graph into compiled kernels, jit_compile is only available from TF 2.5
+    compile_kwargs = {}
+    if jit_compile and 'jit_compile' in inspect.signature(model.compile).parameters:
+        compile_kwargs['jit_compile'] = True
     model.compile(optimizer=tf.keras.optimizers.Adam(),
                   loss=tf.losses.SparseCategoricalCrossentropy(from_logits=True),
-                  metrics=['accuracy'])
+                  metrics=['accuracy'],
+                  **compile_kwargs)
 
     return model
 
 
-def finetune_self_ask(model_name, train_file, valid_file, checkpoint_filepath, max_length = 128, batch_size = 16, epochs = 2, load_in_8bit=False, previous_checkpoint=""):
-  
-    # Create tokenizer and model based on the model_name passed in
-    t5_tokenizer = T5Tokenizer.from_pretrained(model_name)
-    t5_model = TFT5ForConditionalGeneration.from_pretrained(model_name)
-  
-    # Open .JSON file
-    f_train = open(train_file)
-    f_valid = open(valid_file)
+class TokenCacheDataset:
+    '''Serves the memory-mapped token cache to the PyTorch Trainer, padded labels are masked with -100.'''
 
-    # Read .JSON file to JSON object
-    js_train = json.load(f_train)
-    js_valid = json.load(f_valid)
-  
-    # Close JSON file
-    f_train.close()
-    f_valid.close()
-  
-    # Get number of text pairs for train and valid set.
-    n_train_pairs = len(js_train) #154876
-    n_valid_pairs = len(js_valid) #12576
-  
-    del js_train
-    del js_valid
-  
-    train_data_generator = MultihopQADataGenerator(
-        tokenizer=t5_tokenizer,
-        model=t5_model,
-        n_examples=n_train_pairs,
-        data_filename=train_file,
-        max_length=max_length,
-        batch_size=batch_size
-      )
-    
-    valid_data_generator = MultihopQADataGenerator(
-        tokenizer=t5_tokenizer,
+    def __init__(self, data_filename, tokenizer, max_length):
+        self.pad_token_id = tokenizer.pad_token_id
+        self.input_ids, self.attention_mask, self.labels = load_token_cache(
+            data_filename, tokenizer, max_length)
+
+    def __len__(self):
+        return len(self.input_ids)
+
+    def __getitem__(self, idx):
+        labels = np.array(self.labels[idx], dtype=np.int64)
+        labels[labels == self.pad_token_id] = -100
+        return {
+            "input_ids": np.array(self.input_ids[idx], dtype=np.int64),
+            "attention_mask": np.array(self.attention_mask[idx], dtype=np.int64),
+            "labels": labels,
+        }
+
+
+def finetune_self_ask_8bit(model_name, train_file, valid_file, output_dir, max_length = 128, batch_size = 16, epochs = 2, resume_from_checkpoint=None):
+    '''Fine-tunes LoRA adapters on top of 8-bit T5 weights with PyTorch and bitsandbytes.
+
+    The 8-bit weights are frozen, as in finetune-OPT.ipynb, so only the adapters are trained.
+
+    Parameters
+    ----------
+    output_dir : directory for the Trainer checkpoints, the final adapters are saved there too
+    resume_from_checkpoint (optional) : Trainer checkpoint directory (e.g. output_dir/checkpoint-1000)
+        to continue from, Keras .hdf5 weights cannot be used here
+
+    Returns
+    -------
+    The trained peft PeftModel, not a Keras model
+    '''
+    import torch
+    import transformers
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForSeq2SeqLM
+
+    t5_tokenizer = T5TokenizerFast.from_pretrained(model_name)
+    t5_model = AutoModelForSeq2SeqLM.from_pretrained(model_name, load_in_8bit=True, device_map='auto')
+
+    for param in t5_model.parameters():
+        param.requires_grad = False  # freeze the model - train adapters later
+        if param.ndim == 1:
+            # cast the small parameters (e.g. layernorm) to fp32 for stability
+            param.data = param.data.to(torch.float32)
+    t5_model.gradient_checkpointing_enable()  # reduce number of stored activations
+    t5_model.enable_input_require_grads()
+
+    lora_config = LoraConfig(
+        r=16,
+        lora_alpha=32,
+        target_modules=["q", "v"],
+        lora_dropout=0.05,
+        bias="none",
+        task_type="SEQ_2_SEQ_LM"
+    )
+    t5_model = get_peft_model(t5_model, lora_config)
+    t5_model.config.use_cache = False
+
+    trainer = transformers.Trainer(
         model=t5_model,
-        n_examples=n_valid_pairs,
-        data_filename=valid_file,
-        max_length=max_length,
-        batch_size=batch_size
+        train_dataset=TokenCacheDataset(train_file, t5_tokenizer, max_length),
+        eval_dataset=TokenCacheDataset(valid_file, t5_tokenizer, max_length),
+        args=transformers.TrainingArguments(
+            per_device_train_batch_size=batch_size,
+            per_device_eval_batch_size=batch_size,
+            num_train_epochs=epochs,
+            learning_rate=2e-4,
+            fp16=True,
+            evaluation_strategy="epoch",
+            save_steps=1000,
+            output_dir=output_dir,
+        ),
+        data_collator=transformers.default_data_collator
     )
-  
-    model_wrapper = build_t5_training_wrapper_model(t5_model, max_length)
-    
-    if previous_checkpoint != "":
-        model_wrapper.load_weights(previous_checkpoint)
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    t5_model.save_pretrained(output_dir)
 
-    model_checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(
-        filepath=checkpoint_filepath,
-        save_weights_only=True,
-        save_freq=1000)
-  
-    model_wrapper.fit(train_data_generator,
-                      validation_data=valid_data_generator,
-                      epochs=epochs,
-                      callbacks=[model_checkpoint_callback])
-  
-    return model_wrapper
+    return t5_model
 
 
-# TODO disambiguate from evaluation.extract_answer
-def extract_answer_from_target(target: str)-> str:
-    """
-    Find the exact text of the answer given a target with the format "answer is <answer>."
-    """
-    
-    pattern = r'answer is\s*([^\.]+)\.'
+# mixed_float16 is not supported, T5 activations overflow in float16 and the loss is NaN from the first step
+PRECISION_POLICIES = ("float32", "mixed_bfloat16")
 
-    match = re.search(pattern, target)
-    result = None
-    if match:
-        result = match.group(1).strip()
-    
-    return result
 
+def default_precision_policy() -> str:
+    '''Picks "mixed_bfloat16" on TPUs and on GPUs with bfloat16 support (compute capability 8.0+), "float32" otherwise.'''
+    if tf.config.list_logical_devices('TPU'):
+        return "mixed_bfloat16"
+    gpus = tf.config.list_physical_devices('GPU')
+    if gpus and all(
+        tf.config.experimental.get_device_details(gpu).get('compute_capability', (0, 0)) >= (8, 0)
+        for gpu in gpus
+    ):
+        return "mixed_bfloat16"
+    return "float32"
 
-def verify_answer_in_prompt(train_file: str, valid_file: str):
-    """
-    Need to verify the answers in the prompt so that the question can be answered
-    """
-    
-    # load each file of prompts and targets
-    for file in [train_file, valid_file]:
-        file = open(file)
-        js_file = json.load(file)
-        file.close()
-        
-        filtered_js_file = []
-        # only keep the examples with the answer in the prompt
-        for example in js_file:
-            if extract_answer_from_target(example['target']) in example['prompt']:
-                filtered_js_file.append(example)
-
-        # Serializing json
-        filtered_js_file = json.dumps(filtered_js_file)
-        
-        # create new file name, basically append answer verified at the end.
-        new_file = file.replace(".json", "") + '_' + str('answer_verified') + '.json'
-        
-        # Writing to sample.json
-        with open(new_file, 'w') as outfile:
-            outfile.write(filtered_js_file)
 
+def finetune_self_ask(model_name, train_file, valid_file, checkpoint_filepath, max_length = 128, batch_size = 16, epochs = 2, load_in_8bit=False, previous_checkpoint="", precision_policy=None, adapter_dir="", jit_compile=False):
+    '''Fine-tunes a T5 model on prompt/target json files with Keras.
 
-def filter_token_size(train_file, valid_file, token_size):
-    f_train = open(train_file)
-    f_valid = open(valid_file)
-    
-    js_train = json.load(f_train)
-    js_valid = json.load(f_valid)
-    
-    # Close JSON file
-    f_train.close()
-    f_valid.close()
-    
-    filtered_train = [
-        dictionary for dictionary in js_train
-        if dictionary['num_prompt_tokens'] <= token_size
-        ]
-        
-    filtered_dev = [
-        dictionary for dictionary in js_valid
-        if dictionary['num_prompt_tokens'] <= token_size
-        ]
-        
-    # Serializing json
-    train_object = json.dumps(filtered_train)
-    valid_object = json.dumps(filtered_dev)
-    
-    # create new file name, basically append token_size at the end.
-    f_new_train = train_file.replace(".json", "") + '_' + str(token_size) + '.json'
-    f_new_dev = valid_file.replace(".json", "") + '_' + str(token_size) + '.json'
-    
-    # Writing to sample.json
-    with open(f_new_train, 'w') as outfile:
-        outfile.write(train_object)
+    Parameters
+    ----------
+    precision_policy (optional) : "float32" or "mixed_bfloat16", None picks default_precision_policy(),
+        "mixed_float16" raises a ValueError because T5 overflows in float16
+    adapter_dir (optional) : where finetune_self_ask_8bit saves the LoRA adapters, required with load_in_8bit
+    jit_compile (optional) : compile the training step with XLA. XLA recompiles the whole T5 graph
+        for every new (prompt length, target length) bucket, up to (max_length / 32) ** 2 shapes,
+        so the first epoch is much slower, defaults to False
+
+    Returns
+    -------
+    The Keras wrapper model, or a peft PeftModel when load_in_8bit is set
+    '''
+    if precision_policy is not None and precision_policy not in PRECISION_POLICIES:
+        raise ValueError(f"precision_policy must be one of {PRECISION_POLICIES} or None, got {precision_policy!r}, "
+                         "T5 activations overflow in float16 so mixed_float16 trains on NaN losses")
+  
+    # load_in_8bit trains PyTorch LoRA adapters with finetune_self_ask_8bit and returns a PeftModel,
+    # the Keras checkpoint_filepath template and previous_checkpoint weights do not apply to it
+    if load_in_8bit:
+        if not adapter_dir:
+            raise ValueError("load_in_8bit=True trains PyTorch LoRA adapters, pass adapter_dir to choose where they are saved")
+        if previous_checkpoint != "":
+            raise ValueError("previous_checkpoint is a Keras weights file and cannot be loaded into the 8-bit model, "
+                             "call finetune_self_ask_8bit with resume_from_checkpoint to continue a PyTorch run")
+        return finetune_self_ask_8bit(model_name, train_file, valid_file, adapter_dir,
+                                      max_length, batch_size, epochs)
+
+    # Keep weights in float32 but compute activations and gradients in bfloat16, None picks
+    # default_precision_policy() and "float32" disables it. The previous global policy is
+    # restored afterwards so models built later in the same session are not affected.
+    previous_policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy(precision_policy or default_precision_policy())
+    try:
+        # Create tokenizer and model based on the model_name passed in
+        t5_tokenizer = T5TokenizerFast.from_pretrained(model_name)
+        t5_model = TFT5ForConditionalGeneration.from_pretrained(model_name)
+      
+        def data_generator(tokenizer, data_filename):
+            # n_examples=None uses every example in the file, so the json does not have to be read to count them
+            return MultihopQADataGenerator(
+                tokenizer=tokenizer,
+                model=t5_model,
+                n_examples=None,
+                data_filename=data_filename,
+                max_length=max_length,
+                batch_size=batch_size
+            )
+
+        # Build the train and valid token caches concurrently, the Rust tokenizer releases the GIL
+        # while encoding but cannot be shared between threads, so the valid set gets a copy
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            f_train = executor.submit(data_generator, t5_tokenizer, train_file)
+            f_valid = executor.submit(data_generator, copy.deepcopy(t5_tokenizer), valid_file)
+            train_data_generator, valid_data_generator = f_train.result(), f_valid.result()
+      
+        model_wrapper = build_t5_training_wrapper_model(t5_model, max_length, jit_compile=jit_compile)
         
-    with open(f_new_dev, 'w') as outfile:
-        outfile.write(valid_object)
\ No newline at end of file
+        if previous_checkpoint != "":
+            model_wrapper.load_weights(previous_checkpoint)
+
+        model_checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(
+            filepath=checkpoint_filepath,
+            save_weights_only=True,
+            save_freq=1000)
+      
+        model_wrapper.fit(train_data_generator.as_dataset(),
+                          validation_data=valid_data_generator.as_dataset(),
+                          epochs=epochs,
+                          callbacks=[model_checkpoint_callback])
+    finally:
+        tf.keras.mixed_precision.set_global_policy(previous_policy)
+  
+    return model_wrapper